@@ -0,0 +1,139 @@
+"""Локальная заглушка Open-Meteo для нагрузочных замеров без выхода в сеть.
+
+Запуск: uvicorn fake_open_meteo:app --port 8001
+и затем OPEN_METEO_URL=http://127.0.0.1:8001/v1/forecast python script.py
+
+Заглушка умеет имитировать сбои: долю ответов с ошибкой, долю медленных ответов
+и полную недоступность. Настройки меняются на лету через POST /faults, например
+curl -X POST "http://127.0.0.1:8001/faults?error_rate=0.3&slow_rate=0.05&slow_latency=2"
+"""
+import asyncio
+import math
+import os
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+
+# Ежечасные переменные, которые умеет отдавать заглушка
+HOURLY_GENERATORS = {
+    "temperature_2m": lambda lat, lon, hour: round(15 - abs(lat) / 4 + 8 * math.sin(hour / 24 * 2 * math.pi), 1),
+    "relative_humidity_2m": lambda lat, lon, hour: round(60 + 30 * math.sin((hour + lon) / 12), 0),
+    "wind_speed_10m": lambda lat, lon, hour: round(10 + 6 * math.cos((hour + lat) / 9), 1),
+    "precipitation": lambda lat, lon, hour: round(max(0.0, 2 * math.sin((hour + lat + lon) / 5)), 1),
+    "pressure_msl": lambda lat, lon, hour: round(1013 + 12 * math.sin((hour + lon) / 30), 1),
+}
+
+
+def _location_payload(latitude: float, longitude: float, hourly: list, current_weather: bool,
+                      auto_timezone: bool, forecast_days: int) -> dict:
+    """Собирает ответ в формате Open-Meteo для одной точки"""
+    offset_hours = round(longitude / 15) if auto_timezone else 0
+    offset = timedelta(hours=offset_hours)
+    now_local = datetime.now(timezone.utc) + offset
+    start = now_local.replace(hour=0, minute=0, second=0, microsecond=0)
+    # Номер часа от эпохи нужен, чтобы значения не зависели от дня запуска
+    start_hour = int((start - offset).timestamp()) // 3600
+
+    hours = [start + timedelta(hours=i) for i in range(24 * forecast_days)]
+    payload = {
+        "latitude": latitude,
+        "longitude": longitude,
+        "generationtime_ms": 0.1,
+        "utc_offset_seconds": offset_hours * 3600,
+        "timezone": f"Etc/GMT{-offset_hours:+d}" if offset_hours else "GMT",
+        "timezone_abbreviation": "GMT",
+        "elevation": 100.0,
+        "hourly_units": {"time": "iso8601"},
+        "hourly": {"time": [hour.strftime("%Y-%m-%dT%H:%M") for hour in hours]},
+    }
+    for variable in hourly:
+        generator = HOURLY_GENERATORS.get(variable)
+        if generator is None:
+            continue
+        payload["hourly"][variable] = [generator(latitude, longitude, start_hour + i) for i in range(len(hours))]
+
+    if current_weather:
+        current_hour = int(now_local.timestamp() - offset.total_seconds()) // 3600
+        payload["current_weather"] = {
+            "time": now_local.strftime("%Y-%m-%dT%H:00"),
+            "interval": 900,
+            "temperature": HOURLY_GENERATORS["temperature_2m"](latitude, longitude, current_hour),
+            "windspeed": HOURLY_GENERATORS["wind_speed_10m"](latitude, longitude, current_hour),
+            "winddirection": 180,
+            "is_day": 1,
+            "weathercode": 3,
+        }
+    return payload
+
+
+def create_app(latency: float = 0.0, error_rate: float = 0.0, error_status: int = 503,
+               slow_rate: float = 0.0, slow_latency: float = 5.0, seed: Optional[int] = None) -> FastAPI:
+    """Создаёт приложение-заглушку.
+
+    latency - задержка каждого ответа в секундах, error_rate - доля ответов с кодом error_status
+    (для 429 добавляется Retry-After), slow_rate - доля ответов с задержкой slow_latency секунд.
+    """
+    fake = FastAPI()
+    fake.state.requests = 0
+    fake.state.errors = 0
+    fake.state.locations = 0
+    fake.state.faults = {
+        "latency": latency, "error_rate": error_rate, "error_status": error_status,
+        "slow_rate": slow_rate, "slow_latency": slow_latency,
+    }
+    rnd = random.Random(seed)
+
+    @fake.post("/faults")
+    async def set_faults(latency: Optional[float] = None, error_rate: Optional[float] = None,
+                         error_status: Optional[int] = None, slow_rate: Optional[float] = None,
+                         slow_latency: Optional[float] = None):
+        """Меняет настройки сбоев; не переданные параметры остаются прежними"""
+        changes = {"latency": latency, "error_rate": error_rate, "error_status": error_status,
+                   "slow_rate": slow_rate, "slow_latency": slow_latency}
+        fake.state.faults.update({name: value for name, value in changes.items() if value is not None})
+        return fake.state.faults
+
+    @fake.get("/stats")
+    async def get_stats():
+        """Сколько запросов получила заглушка, сколько из них с ошибкой и сколько точек в них было"""
+        return {"requests": fake.state.requests, "errors": fake.state.errors, "locations": fake.state.locations}
+
+    @fake.get("/v1/forecast")
+    async def forecast(latitude: str, longitude: str, hourly: str = "", current_weather: bool = False,
+                       timezone: Optional[str] = None, forecast_days: int = 7):
+        fake.state.requests += 1
+        faults = fake.state.faults
+        delay = faults["slow_latency"] if rnd.random() < faults["slow_rate"] else faults["latency"]
+        if delay:
+            await asyncio.sleep(delay)
+        if rnd.random() < faults["error_rate"]:
+            fake.state.errors += 1
+            headers = {"Retry-After": "1"} if faults["error_status"] == 429 else None
+            return JSONResponse({"error": True, "reason": "Injected failure"},
+                                status_code=faults["error_status"], headers=headers)
+
+        latitudes = [float(value) for value in latitude.split(",")]
+        longitudes = [float(value) for value in longitude.split(",")]
+        fake.state.locations += len(latitudes)
+        variables = [variable for variable in hourly.split(",") if variable]
+        locations = [
+            _location_payload(lat, lon, variables, current_weather, timezone == "auto", forecast_days)
+            for lat, lon in zip(latitudes, longitudes)
+        ]
+        # Как и настоящий API, для одной точки возвращаем объект, для нескольких - список
+        return locations[0] if len(locations) == 1 else locations
+
+    return fake
+
+
+app = create_app(
+    latency=float(os.getenv("FAKE_LATENCY_MS", "0")) / 1000,
+    error_rate=float(os.getenv("FAKE_ERROR_RATE", "0")),
+    error_status=int(os.getenv("FAKE_ERROR_STATUS", "503")),
+    slow_rate=float(os.getenv("FAKE_SLOW_RATE", "0")),
+    slow_latency=float(os.getenv("FAKE_SLOW_MS", "5000")) / 1000,
+)
@@ -0,0 +1,332 @@
+"""Метрики в текстовом формате Prometheus и сэмплирующий профилировщик.
+
+Метрики собираются в памяти процесса и отдаются через /metrics. Счётчики и
+гистограммы обновляются на горячем пути, поэтому сделаны без блокировок:
+всё, кроме профилировщика, работает в потоке цикла событий.
+"""
+import bisect
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+
+# Границы корзин гистограмм задержек по умолчанию, в секундах
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+class Metric:
+    """Общая часть метрик: имя, описание и имена меток"""
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """Монотонно растущий счётчик"""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def set(self, value: float, **labels) -> None:
+        """Переносит значение из уже существующей статистики (например, CacheStats) при сборе"""
+        self._values[self._key(labels)] = value
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """Значение, которое может расти и уменьшаться"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    """Распределение значений по корзинам с накопленными счётчиками, суммой и количеством"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Для каждого набора меток: счётчики по корзинам (последняя - +Inf) и сумма
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="%s"' % _format_value(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Набор метрик процесса. Перед выдачей вызываются функции сбора, обновляющие датчики"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def on_collect(self, collector: Callable[[], None]) -> Callable[[], None]:
+        """Регистрирует функцию, которая обновляет датчики перед выдачей метрик"""
+        self._collectors.append(collector)
+        return collector
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            collector()
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# HTTP-запросы к сервису; route - шаблон пути, чтобы число рядов не зависело от параметров
+http_request_seconds = registry.histogram(
+    "http_request_duration_seconds", "Latency of HTTP requests", ("method", "route", "status")
+)
+http_request_db_queries = registry.histogram(
+    "http_request_db_queries", "Database statements executed per HTTP request", ("route",),
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100),
+)
+http_request_db_seconds = registry.histogram(
+    "http_request_db_seconds", "Time spent in database statements per HTTP request", ("route",)
+)
+
+# Запросы к Open-Meteo
+upstream_request_seconds = registry.histogram(
+    "upstream_request_duration_seconds", "Latency of Open-Meteo requests", ("status",)
+)
+
+# Запросы к базе данных вне зависимости от того, в каком HTTP-запросе они выполнены
+db_query_seconds = registry.histogram(
+    "db_query_duration_seconds", "Latency of database statements", ("engine",),
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+)
+
+
+@dataclass
+class QueryStats:
+    """Запросы к базе данных, выполненные в рамках одного HTTP-запроса"""
+    count: int = 0
+    seconds: float = 0.0
+
+
+# Статистика запросов к базе текущего HTTP-запроса. SQLAlchemy переносит контекст
+# в гринлеты асинхронного драйвера, поэтому обработчики событий курсора видят её
+current_queries: ContextVar[Optional[QueryStats]] = ContextVar("current_queries", default=None)
+
+
+def instrument_engine(sync_engine, name: str) -> None:
+    """Подписывает движок SQLAlchemy на учёт времени и числа выполненных запросов"""
+    from sqlalchemy import event
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        db_query_seconds.observe(elapsed, engine=name)
+        queries = current_queries.get()
+        if queries is not None:
+            queries.count += 1
+            queries.seconds += elapsed
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(context):
+        # Стек времени начала не должен расти из-за запросов, завершившихся ошибкой
+        started = context.connection.info.get("query_started") if context.connection is not None else None
+        if started:
+            started.pop()
+
+
+class MetricsMiddleware:
+    """ASGI-middleware: задержка каждого HTTP-запроса и число и время его запросов к базе данных"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        queries = QueryStats()
+        token = current_queries.set(queries)
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            current_queries.reset(token)
+            # Маршрут появляется в scope после сопоставления пути в роутере FastAPI
+            route = scope.get("route")
+            route = getattr(route, "path", "unmatched")
+            http_request_seconds.observe(time.perf_counter() - started,
+                                         method=scope["method"], route=route, status=status)
+            http_request_db_queries.observe(queries.count, route=route)
+            http_request_db_seconds.observe(queries.seconds, route=route)
+
+
+class SamplingProfiler:
+    """Сэмплирующий профилировщик потока цикла событий.
+
+    Отдельный поток раз в interval секунд снимает стек целевого потока через
+    sys._current_frames() и считает одинаковые стеки. Результат отдаётся в
+    формате "collapsed stacks" (кадры через ";" и число сэмплов), который
+    понимают flamegraph.pl и speedscope. Пока профилировщик выключен, он ничего не стоит.
+    """
+
+    def __init__(self, max_depth: int = 64):
+        self.max_depth = max_depth
+        self.interval = 0.0
+        self.samples = 0
+        self.started_at: Optional[float] = None
+        self._stacks: StackCounter = StackCounter()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._target = threading.main_thread().ident
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval: float = 0.005, thread_id: Optional[int] = None) -> None:
+        """Начинает новый сбор сэмплов потока thread_id (по умолчанию текущего)"""
+        if self.running:
+            raise RuntimeError("Profiler is already running")
+        self.interval = interval
+        self.samples = 0
+        self._stacks = StackCounter()
+        self._target = thread_id if thread_id is not None else threading.get_ident()
+        self._stop.clear()
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> str:
+        """Останавливает сбор и возвращает накопленные стеки"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return self.collapsed()
+
+    def collapsed(self, limit: Optional[int] = None) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self._stacks.most_common(limit))
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self._stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def as_dict(self) -> dict:
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "samples": self.samples,
+            "started_at": self.started_at,
+        }
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,973 @@
+import asyncio
+import importlib.util
+import json
+import logging
+import math
+import os
+import random
+import sqlite3
+import struct
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone, tzinfo
+from typing import Awaitable, Callable, Dict, Hashable, Iterable, Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import httpx
+
+import metrics
+
+
+logger = logging.getLogger("weather.open_meteo")
+
+# Адрес Open-Meteo API, можно подменить на локальную заглушку (см. fake_open_meteo.py)
+OPEN_METEO_URL = os.getenv("OPEN_METEO_URL", "https://api.open-meteo.com/v1/forecast")
+
+# Настройки пула соединений и таймаутов
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))
+
+# Настройки кэша ответов Open-Meteo
+FORECAST_CACHE_MAX_ENTRIES = int(os.getenv("FORECAST_CACHE_MAX_ENTRIES", "10000"))
+FORECAST_CACHE_MIN_TTL = float(os.getenv("FORECAST_CACHE_MIN_TTL", "60"))
+# Общий для процессов одной машины кэш в файле SQLite (пусто - выключен), нужен при uvicorn --workers.
+# Пока он включён, кэш в памяти процесса хранит запись не дольше FORECAST_SHARED_L1_TTL секунд,
+# чтобы прогнозы, обновлённые другим процессом, доходили до всех процессов
+FORECAST_SHARED_CACHE = os.getenv("FORECAST_SHARED_CACHE", "")
+FORECAST_SHARED_L1_TTL = float(os.getenv("FORECAST_SHARED_L1_TTL", "60"))
+# Количество знаков после запятой при округлении координат (2 знака - около 1 км)
+COORDINATE_PRECISION = int(os.getenv("COORDINATE_PRECISION", "2"))
+
+# Ограничение частоты запросов к Open-Meteo (token bucket), 0 - без ограничения
+UPSTREAM_RATE_LIMIT = float(os.getenv("UPSTREAM_RATE_LIMIT", "10"))  # запросов в секунду
+UPSTREAM_BURST = int(os.getenv("UPSTREAM_BURST", "50"))  # допустимый всплеск запросов
+
+# Объединение запросов для разных точек в один запрос к Open-Meteo, 1 - без объединения
+UPSTREAM_BATCH_SIZE = int(os.getenv("UPSTREAM_BATCH_SIZE", "50"))  # точек в одном запросе
+UPSTREAM_BATCH_WAIT = float(os.getenv("UPSTREAM_BATCH_WAIT", "0.01"))  # сколько секунд ждать набора пачки
+
+# Устойчивость к сбоям Open-Meteo: общий бюджет времени на запрос со всеми повторами,
+# таймаут одной попытки, число повторов и экспоненциальная задержка между ними (секунды)
+UPSTREAM_DEADLINE = float(os.getenv("UPSTREAM_DEADLINE", "8"))
+UPSTREAM_ATTEMPT_TIMEOUT = float(os.getenv("UPSTREAM_ATTEMPT_TIMEOUT", "3"))
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.2"))
+UPSTREAM_BACKOFF_MAX = float(os.getenv("UPSTREAM_BACKOFF_MAX", "2"))
+# Автомат отключения: после стольких неудачных попыток подряд запросы не отправляются
+# UPSTREAM_BREAKER_RESET секунд, затем пропускается одна пробная попытка
+UPSTREAM_BREAKER_THRESHOLD = int(os.getenv("UPSTREAM_BREAKER_THRESHOLD", "5"))
+UPSTREAM_BREAKER_RESET = float(os.getenv("UPSTREAM_BREAKER_RESET", "30"))
+# Хеджирование: если ответа нет дольше стольких секунд, отправляется второй такой же запрос (0 - выключено)
+UPSTREAM_HEDGE_DELAY = float(os.getenv("UPSTREAM_HEDGE_DELAY", "0"))
+
+# HTTP/2 включается, только если установлен пакет h2 (pip install httpx[http2])
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1") == "1" and importlib.util.find_spec("h2") is not None
+
+
+@dataclass
+class ConnectionStats:
+    """Счётчики повторного использования соединений с Open-Meteo"""
+    requests: int = 0
+    new_connections: int = 0
+    reused_connections: int = 0
+    http2_requests: int = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "new_connections": self.new_connections,
+            "reused_connections": self.reused_connections,
+            "http2_requests": self.http2_requests,
+            "reuse_ratio": self.reused_connections / self.requests if self.requests else 0.0,
+        }
+
+
+class UpstreamError(Exception):
+    """Open-Meteo вернул ошибку или некорректный ответ"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class UpstreamTimeout(UpstreamError):
+    """Open-Meteo не ответил в отведённый бюджет времени"""
+
+
+class CircuitOpenError(UpstreamError):
+    """Запрос не отправлялся: автомат отключения разомкнут после серии ошибок"""
+
+
+@dataclass
+class ResilienceStats:
+    """Счётчики повторов, хеджирования и автомата отключения"""
+    attempts: int = 0
+    retries: int = 0
+    timeouts: int = 0
+    hedges: int = 0
+    hedge_wins: int = 0
+    short_circuits: int = 0
+    stale_fallbacks: int = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "short_circuits": self.short_circuits,
+            "stale_fallbacks": self.stale_fallbacks,
+        }
+
+
+class CircuitBreaker:
+    """Автомат отключения: closed -> open после failure_threshold ошибок подряд,
+    open -> half_open через reset_timeout секунд, в half_open пропускается одна пробная попытка"""
+
+    def __init__(self, failure_threshold: int = UPSTREAM_BREAKER_THRESHOLD,
+                 reset_timeout: float = UPSTREAM_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос сейчас"""
+        if self.state == "closed" or self.failure_threshold <= 0:
+            return True
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self.state = "half_open"
+            self._probing = False
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self) -> None:
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def release(self) -> None:
+        """Попытка, разрешённая allow(), не состоялась (истёк бюджет или её отменили): в half_open
+        снова можно отправить пробную попытку"""
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if self.failure_threshold > 0 and (self.state == "half_open" or self.failures >= self.failure_threshold):
+            if self.state != "open":
+                self.opened += 1
+                logger.warning("Open-Meteo circuit breaker opened after %s failures", self.failures)
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+    def as_dict(self) -> dict:
+        return {"state": self.state, "consecutive_failures": self.failures, "opened": self.opened}
+
+
+def _retry_after(response: httpx.Response) -> Optional[float]:
+    """Задержка из заголовка Retry-After в секундах, если он задан числом"""
+    try:
+        return max(0.0, float(response.headers["Retry-After"]))
+    except (KeyError, ValueError):
+        return None
+
+
+class HourlyForecast:
+    """Почасовой прогноз для одной точки, разобранный из ответа Open-Meteo один раз.
+
+    Время хранится как номер часа от эпохи (UTC), значения каждой переменной - массивом float64
+    (NaN - нет данных), поэтому поиск значения на любой час выполняется за O(1) без разбора строк.
+    Местное время точки переводится в UTC по её часовому поясу с учётом перехода на летнее время.
+    """
+
+    __slots__ = ("timezone", "utc_offset_seconds", "first_hour", "length", "values", "current",
+                 "current_hour", "fetched_at", "_tz", "_index")
+
+    def __init__(self, timezone_name: str, utc_offset_seconds: int, hours: list, values: Dict[str, array],
+                 current: Optional[dict] = None, current_hour: Optional[int] = None,
+                 fetched_at: Optional[float] = None):
+        self.timezone = timezone_name
+        self.utc_offset_seconds = utc_offset_seconds
+        self._tz = _location_timezone(timezone_name, utc_offset_seconds)
+        self.first_hour = hours[0] if hours else 0
+        self.length = len(hours)
+        self.values = values
+        self.current = current
+        self.current_hour = current_hour
+        self.fetched_at = time.time() if fetched_at is None else fetched_at
+        # Обычно часы идут подряд и хватает смещения от первого часа, иначе нужен словарь
+        contiguous = all(hour == self.first_hour + position for position, hour in enumerate(hours))
+        self._index = None if contiguous else {hour: position for position, hour in enumerate(hours)}
+
+    @classmethod
+    def from_payload(cls, payload: dict) -> "HourlyForecast":
+        timezone_name = payload.get("timezone", "GMT")
+        utc_offset_seconds = payload.get("utc_offset_seconds", 0)
+        tz = _location_timezone(timezone_name, utc_offset_seconds)
+        hourly = payload.get("hourly", {})
+
+        # При переходе на зимнее время местный час повторяется: второе его появление в списке
+        # относится к следующему часу UTC (fold=1), иначе оба значения попали бы в один час
+        hours = []
+        for moment in hourly.get("time", []):
+            local = datetime.fromisoformat(moment).replace(tzinfo=tz)
+            hour = int(local.timestamp()) // 3600
+            if hours and hour <= hours[-1]:
+                hour = int(local.replace(fold=1).timestamp()) // 3600
+            hours.append(hour)
+        values = {
+            variable: array("d", (math.nan if value is None else value for value in series))
+            for variable, series in hourly.items() if variable != "time"
+        }
+        current = payload.get("current_weather")
+        # utc_offset_seconds - смещение на момент ответа, оно однозначно и для повторяющегося часа
+        current_offset = timezone(timedelta(seconds=utc_offset_seconds))
+        current_hour = (
+            int(datetime.fromisoformat(current["time"]).replace(tzinfo=current_offset).timestamp()) // 3600
+            if current else None
+        )
+        return cls(timezone_name, utc_offset_seconds, hours, values, current, current_hour)
+
+    def offset(self, epoch_hour: int) -> Optional[int]:
+        """Позиция часа в массивах значений или None, если час вне прогноза"""
+        if self._index is not None:
+            return self._index.get(epoch_hour)
+        position = epoch_hour - self.first_hour
+        return position if 0 <= position < self.length else None
+
+    def value(self, variable: str, epoch_hour: int) -> Optional[float]:
+        position = self.offset(epoch_hour)
+        if position is None:
+            return None
+        value = self.values[variable][position]
+        return None if value != value else value
+
+    def local_hour(self, day: date, hour: int) -> int:
+        """Номер часа от эпохи для местного времени точки"""
+        return int(datetime(day.year, day.month, day.day, hour, tzinfo=self._tz).timestamp()) // 3600
+
+    def local_time(self, epoch_hour: int) -> datetime:
+        """Местное время точки для номера часа от эпохи"""
+        return datetime.fromtimestamp(epoch_hour * 3600, tz=self._tz)
+
+    def hours(self) -> Iterable[int]:
+        """Номера часов прогноза по порядку"""
+        if self._index is not None:
+            return iter(self._index)
+        return range(self.first_hour, self.first_hour + self.length)
+
+    def to_bytes(self) -> bytes:
+        """Представление для общего кэша процессов: длина заголовка, заголовок JSON и массивы значений подряд"""
+        header = json.dumps({
+            "timezone": self.timezone,
+            "utc_offset_seconds": self.utc_offset_seconds,
+            "first_hour": self.first_hour,
+            "length": self.length,
+            "hours": list(self._index) if self._index is not None else None,
+            "current": self.current,
+            "current_hour": self.current_hour,
+            "fetched_at": self.fetched_at,
+            "variables": list(self.values),
+        }).encode()
+        return b"".join([_HEADER_SIZE.pack(len(header)), header] + [series.tobytes() for series in self.values.values()])
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HourlyForecast":
+        (size,) = _HEADER_SIZE.unpack_from(data)
+        position = _HEADER_SIZE.size + size
+        header = json.loads(data[_HEADER_SIZE.size:position])
+        hours = header["hours"]
+        if hours is None:
+            hours = range(header["first_hour"], header["first_hour"] + header["length"])
+        values = {}
+        for variable in header["variables"]:
+            series = array("d")
+            end = position + header["length"] * series.itemsize
+            series.frombytes(data[position:end])
+            values[variable] = series
+            position = end
+        return cls(header["timezone"], header["utc_offset_seconds"], hours, values,
+                   header["current"], header["current_hour"], header["fetched_at"])
+
+
+_HEADER_SIZE = struct.Struct("<I")
+
+
+def _location_timezone(timezone_name: str, utc_offset_seconds: int) -> tzinfo:
+    """Часовой пояс точки; если база часовых поясов недоступна - фиксированное смещение из ответа"""
+    try:
+        return ZoneInfo(timezone_name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return timezone(timedelta(seconds=utc_offset_seconds))
+
+
+def round_coordinate(value: float) -> float:
+    """Округляет координату до точности ключа кэша"""
+    return round(value, COORDINATE_PRECISION)
+
+
+def seconds_until_next_hour(now: Optional[float] = None) -> float:
+    """Почасовые данные Open-Meteo меняются раз в час, поэтому кэш живёт до начала следующего часа"""
+    now = time.time() if now is None else now
+    return 3600 - now % 3600
+
+
+@dataclass
+class CacheStats:
+    """Счётчики попаданий и промахов кэша"""
+    hits: int = 0
+    misses: int = 0
+    coalesced: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+    def as_dict(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class TokenBucket:
+    """Ограничитель частоты: rate запросов в секунду с допустимым всплеском capacity"""
+
+    def __init__(self, rate: float = UPSTREAM_RATE_LIMIT, capacity: int = UPSTREAM_BURST):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        # Под блокировкой ожидающие получают токены по очереди
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ForecastCache:
+    """LRU-кэш ответов Open-Meteo с временем жизни и объединением одновременных запросов.
+
+    Пока загрузка по ключу не завершилась, все остальные запросы по тому же ключу
+    ждут её результата, а не идут в Open-Meteo повторно.
+    """
+
+    def __init__(self, max_entries: int = FORECAST_CACHE_MAX_ENTRIES, min_ttl: float = FORECAST_CACHE_MIN_TTL,
+                 clock: Callable[[], float] = time.time, max_ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.clock = clock
+        self.stats = CacheStats()
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._inflight: dict = {}
+
+    @staticmethod
+    def make_key(latitude: float, longitude: float, params: dict) -> tuple:
+        return round_coordinate(latitude), round_coordinate(longitude), tuple(sorted(params.items()))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable):
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > self.clock():
+                self._entries.move_to_end(key)
+                self.stats.hits += 1
+                return value
+            del self._entries[key]
+            self.stats.expirations += 1
+        self.stats.misses += 1
+        return None
+
+    def set(self, key: Hashable, value, ttl: Optional[float] = None) -> None:
+        now = self.clock()
+        if ttl is None:
+            ttl = max(seconds_until_next_hour(now), self.min_ttl)
+        if self.max_ttl is not None:
+            ttl = min(ttl, self.max_ttl)
+        self._entries[key] = (now + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def peek(self, key: Hashable):
+        """Значение по ключу без учёта срока жизни и без изменения статистики"""
+        entry = self._entries.get(key)
+        return entry[1] if entry is not None else None
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable], refresh: bool = False):
+        """Значение из кэша или из loader; при refresh=True кэш не читается, но загрузка всё равно объединяется"""
+        if not refresh:
+            value = self.get(key)
+            if value is not None:
+                return value
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key, loader))
+            self._inflight[key] = task
+        else:
+            self.stats.coalesced += 1
+        # Отмена одного из ожидающих не должна отменять общую загрузку
+        return await asyncio.shield(task)
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable]):
+        try:
+            value = await loader()
+            self.set(key, value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+
+@dataclass
+class SharedCacheStats:
+    """Счётчики общего кэша процессов"""
+    hits: int = 0
+    misses: int = 0
+    # Сколько раз процесс ждал загрузку, начатую другим процессом, и сколько раз дождался
+    waits: int = 0
+    wait_hits: int = 0
+    errors: int = 0
+
+    def as_dict(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "waits": self.waits,
+            "wait_hits": self.wait_hits,
+            "errors": self.errors,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class SharedForecastCache:
+    """Кэш прогнозов в файле SQLite, общий для процессов одной машины.
+
+    Процессы uvicorn --workers не делят память, и без общего уровня каждый из них запрашивал бы
+    одну и ту же точку у Open-Meteo сам. Прогноз, полученный одним процессом, записывается сюда,
+    и остальные берут его при промахе своего кэша в памяти. Загрузку точки застолбляет один
+    процесс (claim), остальные ждут его результата не дольше срока заявки. Обращения к файлу
+    выполняются в отдельном потоке; ошибки SQLite не ломают запросы, а только отключают общий
+    уровень для этого обращения.
+    """
+
+    def __init__(self, path: str, poll_interval: float = 0.02, keep_expired: float = 3600,
+                 prune_every: int = 1000):
+        self.path = path
+        self.poll_interval = poll_interval
+        # Сколько секунд хранить истёкшие записи, прежде чем удалить их из файла
+        self.keep_expired = keep_expired
+        self.prune_every = prune_every
+        self.holder = f"{os.getpid()}:{id(self):x}"
+        self.stats = SharedCacheStats()
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        # Соединение открывается при первом обращении, то есть уже в процессе воркера
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=1.0, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # Потеря кэша при сбое питания не страшна
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS forecasts ("
+                "key TEXT PRIMARY KEY, fetched_at REAL NOT NULL, expires_at REAL NOT NULL, data BLOB NOT NULL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._connection = connection
+        return self._connection
+
+    async def _run(self, operation: Callable, *args, default=None):
+        def locked():
+            with self._lock:
+                return operation(self._connect(), *args)
+
+        try:
+            return await asyncio.to_thread(locked)
+        except sqlite3.Error as err:
+            self.stats.errors += 1
+            logger.warning("Shared forecast cache %s is unavailable: %s", self.path, err)
+            return default
+
+    @staticmethod
+    def _select(connection: sqlite3.Connection, key: str, fetched_after: Optional[float]) -> Optional[bytes]:
+        if fetched_after is None:
+            row = connection.execute("SELECT data FROM forecasts WHERE key = ? AND expires_at > ?",
+                                     (key, time.time())).fetchone()
+        else:
+            row = connection.execute("SELECT data FROM forecasts WHERE key = ? AND fetched_at >= ?",
+                                     (key, fetched_after)).fetchone()
+        return row[0] if row else None
+
+    async def get(self, key: str) -> Optional[HourlyForecast]:
+        """Неистёкший прогноз по ключу или None"""
+        data = await self._run(self._select, key, None)
+        if data is None:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        return HourlyForecast.from_bytes(data)
+
+    async def set(self, key: str, forecast: HourlyForecast, expires_at: float) -> None:
+        def write(connection: sqlite3.Connection):
+            connection.execute(
+                "INSERT INTO forecasts (key, fetched_at, expires_at, data) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET fetched_at = excluded.fetched_at, "
+                "expires_at = excluded.expires_at, data = excluded.data WHERE excluded.fetched_at >= forecasts.fetched_at",
+                (key, forecast.fetched_at, expires_at, forecast.to_bytes()),
+            )
+            self._writes += 1
+            if self._writes % self.prune_every == 0:
+                connection.execute("DELETE FROM forecasts WHERE expires_at < ?", (time.time() - self.keep_expired,))
+                connection.execute("DELETE FROM claims WHERE expires_at < ?", (time.time(),))
+
+        await self._run(write)
+
+    async def claim(self, key: str, ttl: float) -> bool:
+        """Застолбить загрузку ключа на ttl секунд; False - его уже загружает другой процесс"""
+        def insert(connection: sqlite3.Connection) -> bool:
+            now = time.time()
+            cursor = connection.execute(
+                "INSERT INTO claims (key, holder, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+                "WHERE claims.expires_at < ?",
+                (key, self.holder, now + ttl, now),
+            )
+            return cursor.rowcount == 1
+
+        # Если файл недоступен, процесс загружает прогноз сам
+        return await self._run(insert, default=True)
+
+    async def release(self, key: str) -> None:
+        def delete(connection: sqlite3.Connection):
+            connection.execute("DELETE FROM claims WHERE key = ? AND holder = ?", (key, self.holder))
+
+        await self._run(delete)
+
+    async def wait(self, key: str, timeout: float, fetched_after: Optional[float] = None) -> Optional[HourlyForecast]:
+        """Ждёт прогноз, который загружает другой процесс. None - заявка снята или истекла без результата.
+
+        fetched_after задаёт, начиная с какого времени получения прогноз подходит (для принудительного
+        обновления), по умолчанию подходит любой неистёкший.
+        """
+        def poll(connection: sqlite3.Connection) -> tuple:
+            data = self._select(connection, key, fetched_after)
+            if data is not None:
+                return data, False
+            claimed = connection.execute("SELECT 1 FROM claims WHERE key = ? AND expires_at > ?",
+                                         (key, time.time())).fetchone()
+            return None, claimed is not None
+
+        self.stats.waits += 1
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            data, claimed = await self._run(poll, default=(None, False))
+            if data is not None:
+                self.stats.wait_hits += 1
+                return HourlyForecast.from_bytes(data)
+            if not claimed:
+                return None
+            await asyncio.sleep(self.poll_interval)
+        return None
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+@dataclass
+class BatchStats:
+    """Счётчики объединения точек в запросы к Open-Meteo"""
+    batches: int = 0
+    locations: int = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "batches": self.batches,
+            "locations": self.locations,
+            "locations_per_batch": self.locations / self.batches if self.batches else 0.0,
+        }
+
+
+class ForecastBatcher:
+    """Собирает запросы прогнозов для разных точек в один запрос к Open-Meteo.
+
+    Open-Meteo принимает списки широт и долгот через запятую и возвращает массив ответов
+    в том же порядке. Пачка отправляется, когда набралось max_batch_size точек или прошло
+    max_wait секунд с момента появления первой точки в пачке. В одну пачку попадают только
+    запросы с одинаковыми параметрами.
+    """
+
+    def __init__(self, send: Callable[[dict], Awaitable[httpx.Response]],
+                 max_batch_size: int = UPSTREAM_BATCH_SIZE, max_wait: float = UPSTREAM_BATCH_WAIT):
+        self.send = send
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = BatchStats()
+        self._pending: dict = {}
+        self._timers: dict = {}
+        self._tasks: set = set()
+
+    async def fetch(self, latitude: float, longitude: float, params: dict) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        if self.max_batch_size <= 1:
+            await self._send([(latitude, longitude, future)], params)
+            return await future
+
+        key = tuple(sorted(params.items()))
+        batch = self._pending.setdefault(key, [])
+        batch.append((latitude, longitude, future))
+        if len(batch) >= self.max_batch_size:
+            self._flush(key)
+        elif len(batch) == 1:
+            self._timers[key] = asyncio.get_running_loop().call_later(self.max_wait, self._flush, key)
+        return await future
+
+    def _flush(self, key: tuple) -> None:
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, None)
+        if batch:
+            task = asyncio.create_task(self._send(batch, dict(key)))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: list, params: dict) -> None:
+        self.stats.batches += 1
+        self.stats.locations += len(batch)
+        try:
+            response = await self.send({
+                "latitude": ",".join(str(latitude) for latitude, _, _ in batch),
+                "longitude": ",".join(str(longitude) for _, longitude, _ in batch),
+                **params,
+            })
+            if response.status_code != 200:
+                raise UpstreamError("Failed to fetch weather data", status_code=response.status_code)
+            payload = response.json()
+            # Для одной точки Open-Meteo возвращает объект, для нескольких - список
+            locations = payload if isinstance(payload, list) else [payload]
+            if len(locations) != len(batch):
+                raise UpstreamError("Unexpected number of locations in weather data")
+        except Exception as err:
+            if not isinstance(err, UpstreamError):
+                err = UpstreamError(f"Invalid weather data: {err}")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(err)
+            return
+
+        for (_, _, future), location in zip(batch, locations):
+            if not future.done():
+                future.set_result(location)
+
+
+class OpenMeteoClient:
+    """Долгоживущий HTTP-клиент для Open-Meteo с общим пулом keep-alive соединений.
+
+    Клиент создаётся один раз в lifespan приложения и закрывается при его остановке.
+    """
+
+    def __init__(
+        self,
+        base_url: str = OPEN_METEO_URL,
+        limits: Optional[httpx.Limits] = None,
+        timeout: Optional[httpx.Timeout] = None,
+        http2: bool = HTTP2_ENABLED,
+        cache: Optional[ForecastCache] = None,
+        rate_limiter: Optional[TokenBucket] = None,
+        batcher: Optional[ForecastBatcher] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        deadline: float = UPSTREAM_DEADLINE,
+        attempt_timeout: float = UPSTREAM_ATTEMPT_TIMEOUT,
+        retries: int = UPSTREAM_RETRIES,
+        hedge_delay: float = UPSTREAM_HEDGE_DELAY,
+        shared_cache: Optional[SharedForecastCache] = None,
+    ):
+        self.base_url = base_url
+        self.limits = limits or httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        )
+        self.timeout = timeout or httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        self.http2 = http2
+        self.stats = ConnectionStats()
+        if shared_cache is None and FORECAST_SHARED_CACHE:
+            shared_cache = SharedForecastCache(FORECAST_SHARED_CACHE)
+        self.shared_cache = shared_cache
+        if cache is None:
+            cache = ForecastCache(max_ttl=FORECAST_SHARED_L1_TTL if shared_cache is not None else None)
+        self.cache = cache
+        self.rate_limiter = rate_limiter if rate_limiter is not None else TokenBucket()
+        self.batcher = batcher if batcher is not None else ForecastBatcher(self.send)
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.retries = retries
+        self.hedge_delay = hedge_delay
+        self.resilience = ResilienceStats()
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def start(self) -> None:
+        if self._client is None:
+            self._client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout, http2=self.http2)
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self.shared_cache is not None:
+            self.shared_cache.close()
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError("Open-Meteo client is not started, call start() first")
+        return self._client
+
+    async def get_forecast(self, params: dict) -> httpx.Response:
+        """Выполняет запрос к /v1/forecast через общий пул с учётом ограничения частоты"""
+        await self.rate_limiter.acquire()
+        return await self._request(params)
+
+    async def _request(self, params: dict) -> httpx.Response:
+        """Один запрос к /v1/forecast через общий пул, учитывает переиспользование соединения"""
+        connected = False
+
+        async def trace(event_name: str, info: dict) -> None:
+            nonlocal connected
+            # Событие установки TCP-соединения появляется только для нового соединения
+            if event_name == "connection.connect_tcp.started":
+                connected = True
+
+        started = time.perf_counter()
+        try:
+            response = await self.client.get(self.base_url, params=params, extensions={"trace": trace})
+        except httpx.HTTPError as err:
+            metrics.upstream_request_seconds.observe(time.perf_counter() - started, status=type(err).__name__)
+            raise
+        metrics.upstream_request_seconds.observe(time.perf_counter() - started, status=response.status_code)
+
+        self.stats.requests += 1
+        if connected:
+            self.stats.new_connections += 1
+        else:
+            self.stats.reused_connections += 1
+        if response.http_version == "HTTP/2":
+            self.stats.http2_requests += 1
+
+        logger.debug(
+            "GET %s status=%s reused=%s http_version=%s elapsed=%.3fs",
+            self.base_url, response.status_code, not connected, response.http_version,
+            time.perf_counter() - started,
+        )
+        return response
+
+    async def send(self, params: dict) -> httpx.Response:
+        """Запрос к Open-Meteo с бюджетом времени, повторами, автоматом отключения и хеджированием.
+
+        Повторяются сетевые ошибки, таймауты попытки, 429 и 5xx: с экспоненциальной задержкой
+        со случайным разбросом или по Retry-After, пока хватает бюджета self.deadline.
+        Остальные ответы возвращаются как есть. Бросает UpstreamError (и его подклассы).
+        """
+        until = None
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self.resilience.short_circuits += 1
+                raise CircuitOpenError("Open-Meteo is unavailable, circuit breaker is open")
+
+            # Каждый выход после allow() должен сообщить автомату исход, иначе пробная попытка
+            # в half_open останется занятой навсегда
+            recorded = False
+            try:
+                # Ожидание в очереди ограничителя частоты не считается медленным ответом Open-Meteo,
+                # поэтому бюджет отсчитывается от первой попытки, а таймаут попытки - от отправки запроса
+                await self.rate_limiter.acquire()
+                if until is None:
+                    until = time.monotonic() + self.deadline
+                remaining = until - time.monotonic()
+                if remaining <= 0:
+                    self.resilience.timeouts += 1
+                    raise UpstreamTimeout(f"Open-Meteo did not respond within {self.deadline}s")
+                retry_after = None
+                self.resilience.attempts += 1
+                try:
+                    response = await asyncio.wait_for(self._attempt(params), min(self.attempt_timeout, remaining))
+                except asyncio.TimeoutError:
+                    self.resilience.timeouts += 1
+                    error = UpstreamTimeout(
+                        f"Open-Meteo did not respond within {min(self.attempt_timeout, remaining):.1f}s"
+                    )
+                except httpx.HTTPError as err:
+                    error = UpstreamError(f"Failed to fetch weather data: {err!r}")
+                else:
+                    if response.status_code != 429 and response.status_code < 500:
+                        # Open-Meteo отвечает, даже если это ошибка запроса
+                        self.breaker.record_success()
+                        recorded = True
+                        return response
+                    error = UpstreamError("Failed to fetch weather data", status_code=response.status_code)
+                    retry_after = _retry_after(response)
+                self.breaker.record_failure()
+                recorded = True
+            finally:
+                if not recorded:
+                    self.breaker.release()
+
+            attempt += 1
+            delay = retry_after if retry_after is not None else random.uniform(
+                0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * 2 ** attempt)
+            )
+            if attempt > self.retries or time.monotonic() + delay >= until:
+                raise error
+            self.resilience.retries += 1
+            logger.debug("Retrying Open-Meteo request in %.2fs after: %s", delay, error)
+            await asyncio.sleep(delay)
+
+    async def _attempt(self, params: dict) -> httpx.Response:
+        """Одна попытка; при включённом хеджировании через hedge_delay без ответа отправляется второй запрос"""
+        if self.hedge_delay <= 0:
+            return await self._request(params)
+
+        first = asyncio.create_task(self._request(params))
+        pending = {first}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=self.hedge_delay)
+            if not done:
+                self.resilience.hedges += 1
+                pending.add(asyncio.create_task(self.get_forecast(params)))
+            error = None
+            while True:
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.resilience.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    raise error
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # Запрос, проигравший гонку, больше не нужен
+            for task in pending:
+                task.cancel()
+
+    async def fetch_forecast(self, latitude: float, longitude: float, refresh: bool = False,
+                             deadline: Optional[float] = None, allow_stale: bool = False,
+                             **params) -> HourlyForecast:
+        """Возвращает прогноз для точки из кэша или из Open-Meteo.
+
+        Координаты округляются до точности ключа кэша, поэтому близкие точки
+        обслуживаются одним запросом к Open-Meteo. При refresh=True прогноз
+        запрашивается заново, даже если в кэше есть неистёкшая запись.
+        deadline ограничивает ожидание вызывающего (сама загрузка продолжается
+        и попадёт в кэш), allow_stale разрешает вернуть устаревший прогноз
+        из кэша, если Open-Meteo недоступен.
+        """
+        latitude, longitude, params = self._normalize(latitude, longitude, params)
+        key = self.cache.make_key(latitude, longitude, params)
+        load = self.cache.get_or_load(key, lambda: self._load(key, latitude, longitude, params, refresh),
+                                      refresh=refresh)
+        try:
+            if deadline is None:
+                return await load
+            try:
+                return await asyncio.wait_for(load, deadline)
+            except asyncio.TimeoutError:
+                raise UpstreamTimeout(f"Open-Meteo did not respond within {deadline}s") from None
+        except UpstreamError:
+            stale = self.cache.peek(key) if allow_stale else None
+            if stale is None:
+                raise
+            self.resilience.stale_fallbacks += 1
+            return stale
+
+    def peek_forecast(self, latitude: float, longitude: float, **params) -> Optional[HourlyForecast]:
+        """Прогноз из кэша, даже устаревший, без запроса к Open-Meteo"""
+        latitude, longitude, params = self._normalize(latitude, longitude, params)
+        return self.cache.peek(self.cache.make_key(latitude, longitude, params))
+
+    @staticmethod
+    def _normalize(latitude: float, longitude: float, params: dict) -> tuple:
+        if isinstance(params.get("hourly"), (list, tuple, set, frozenset)):
+            params["hourly"] = ",".join(sorted(params["hourly"]))
+        return round_coordinate(latitude), round_coordinate(longitude), params
+
+    async def _load(self, key: tuple, latitude: float, longitude: float, params: dict,
+                    refresh: bool) -> HourlyForecast:
+        """Загрузка при промахе кэша в памяти: сначала общий кэш процессов, если он включён"""
+        shared = self.shared_cache
+        if shared is None:
+            return await self._fetch(latitude, longitude, params)
+
+        shared_key = repr(key)
+        started = time.time()
+        if not refresh:
+            forecast = await shared.get(shared_key)
+            if forecast is not None:
+                return forecast
+        if not await shared.claim(shared_key, self.deadline):
+            # Точку уже загружает другой процесс; при refresh нужен прогноз, полученный после нашего запроса
+            forecast = await shared.wait(shared_key, self.deadline, fetched_after=started if refresh else None)
+            if forecast is not None:
+                return forecast
+        try:
+            forecast = await self._fetch(latitude, longitude, params)
+            expires_at = forecast.fetched_at + max(seconds_until_next_hour(forecast.fetched_at), self.cache.min_ttl)
+            await shared.set(shared_key, forecast, expires_at)
+            return forecast
+        finally:
+            await shared.release(shared_key)
+
+    async def _fetch(self, latitude: float, longitude: float, params: dict) -> HourlyForecast:
+        # Ответ разбирается один раз, в кэше хранится уже готовая структура
+        return HourlyForecast.from_payload(await self.batcher.fetch(latitude, longitude, params))
+
+
+# Общий клиент приложения, запускается и останавливается в lifespan
+open_meteo = OpenMeteoClient()
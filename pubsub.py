@@ -0,0 +1,171 @@
+"""Оповещения подписчиков внутри процесса.
+
+Подписка слушает набор тем (например, "city:42"). Публикация в тему не ждёт подписчиков:
+значение кладётся в почтовый ящик каждой подписки и заменяет там предыдущее значение
+той же темы, которое подписчик ещё не забрал. Поэтому медленный клиент не копит очередь
+сообщений - в его ящике не больше одного значения на тему, - а публикующий никогда не
+блокируется. Пока подписке нечего отдать, у неё нет ящика, а ожидание - это одна
+Future без отдельной задачи, поэтому простаивающая подписка стоит несколько сотен байт.
+"""
+import asyncio
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Set
+
+
+class BrokerFull(Exception):
+    """Достигнуто максимальное число подписок"""
+
+
+class Subscription:
+    """Подписка на набор тем с почтовым ящиком, в котором хранится последнее значение каждой темы"""
+
+    __slots__ = ("topics", "closed", "active", "_pending", "_waiter")
+
+    def __init__(self):
+        self.topics: Set[str] = set()
+        self.closed = False
+        # Подписка зарегистрирована в брокере и ещё не отписана
+        self.active = True
+        self._pending: Optional[Dict[str, object]] = None
+        self._waiter: Optional[asyncio.Future] = None
+
+    def _put(self, topic: str, value) -> bool:
+        """Кладёт значение в ящик; True, если оно заменило ещё не забранное значение той же темы"""
+        if self._pending is None:
+            self._pending = {}
+        replaced = topic in self._pending
+        self._pending[topic] = value
+        _wake(self._waiter)
+        return replaced
+
+    def close(self) -> None:
+        """Прерывает ожидание в get(); дальше get() сразу возвращает то, что осталось в ящике"""
+        self.closed = True
+        _wake(self._waiter)
+
+    async def get(self, timeout: Optional[float] = None) -> Dict[str, object]:
+        """Забирает накопившиеся значения по темам; пустой словарь, если за timeout ничего не пришло"""
+        if self._pending is None and not self.closed:
+            loop = asyncio.get_running_loop()
+            self._waiter = waiter = loop.create_future()
+            timer = loop.call_later(timeout, _wake, waiter) if timeout is not None else None
+            try:
+                await waiter
+            finally:
+                self._waiter = None
+                if timer is not None:
+                    timer.cancel()
+        pending, self._pending = self._pending or {}, None
+        return pending
+
+
+def _wake(waiter: Optional[asyncio.Future]) -> None:
+    if waiter is not None and not waiter.done():
+        waiter.set_result(None)
+
+
+@dataclass
+class BrokerStats:
+    """Счётчики оповещений"""
+    subscribers: int = 0
+    published: int = 0
+    # Публикации без изменений по сравнению с последним значением темы
+    unchanged: int = 0
+    delivered: int = 0
+    # Значения, заменившие ещё не отправленные подписчику
+    coalesced: int = 0
+    rejected: int = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "subscribers": self.subscribers,
+            "published": self.published,
+            "unchanged": self.unchanged,
+            "delivered": self.delivered,
+            "coalesced": self.coalesced,
+            "rejected": self.rejected,
+        }
+
+
+class Broker:
+    """Темы и их подписки. Последнее значение темы хранится, пока у неё есть подписчики,
+    и повторная публикация того же значения подписчикам не отправляется.
+
+    Все методы вызываются из потока цикла событий.
+    """
+
+    def __init__(self, max_subscribers: int = 0):
+        self.max_subscribers = max_subscribers
+        self.stats = BrokerStats()
+        self._subscribers: Dict[str, Set[Subscription]] = {}
+        self._last: Dict[str, object] = {}
+
+    def subscribe(self, topics: Iterable[str]) -> Subscription:
+        if self.max_subscribers and self.stats.subscribers >= self.max_subscribers:
+            self.stats.rejected += 1
+            raise BrokerFull(f"Too many subscriptions ({self.max_subscribers})")
+        subscription = Subscription()
+        self.stats.subscribers += 1
+        self.add_topics(subscription, topics)
+        return subscription
+
+    def add_topics(self, subscription: Subscription, topics: Iterable[str]) -> None:
+        for topic in topics:
+            if topic not in subscription.topics:
+                subscription.topics.add(topic)
+                self._subscribers.setdefault(topic, set()).add(subscription)
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        """Удаляет подписку из её тем; повторный вызов ничего не делает"""
+        if not subscription.active:
+            return
+        subscription.active = False
+        for topic in subscription.topics:
+            subscribers = self._subscribers.get(topic)
+            if subscribers is None:
+                continue
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[topic]
+                self._last.pop(topic, None)
+        subscription.topics = set()
+        self.stats.subscribers -= 1
+
+    def has_subscribers(self, topic: str) -> bool:
+        return topic in self._subscribers
+
+    def count(self, topic: str) -> int:
+        """Число подписок на тему"""
+        return len(self._subscribers.get(topic, ()))
+
+    def subscribers(self, topic: str) -> List[Subscription]:
+        return list(self._subscribers.get(topic, ()))
+
+    def topics(self) -> List[str]:
+        """Темы, у которых сейчас есть подписчики"""
+        return list(self._subscribers)
+
+    def remember(self, topic: str, value, key=None) -> None:
+        """Запоминает значение, которое подписчики уже получили другим путём (например, начальный снимок)"""
+        if topic in self._subscribers:
+            self._last[topic] = value if key is None else key
+
+    def publish(self, topic: str, value, key=None) -> int:
+        """Отправляет значение подписчикам темы, если оно изменилось. Возвращает число получателей.
+
+        Значения сравниваются по key, если он передан (например, без времени получения), иначе целиком.
+        """
+        subscribers = self._subscribers.get(topic)
+        if not subscribers:
+            return 0
+        key = value if key is None else key
+        if self._last.get(topic) == key:
+            self.stats.unchanged += 1
+            return 0
+        self._last[topic] = key
+        self.stats.published += 1
+        for subscription in subscribers:
+            if subscription._put(topic, value):
+                self.stats.coalesced += 1
+        self.stats.delivered += len(subscribers)
+        return len(subscribers)
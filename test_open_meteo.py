@@ -0,0 +1,332 @@
+"""Общий пул соединений, кэш с объединением запросов, пачки точек, повторы, бюджет времени,
+автомат отключения, хеджирование и устаревшие данные клиента Open-Meteo, разбор времени ответа.
+
+Клиент ходит в заглушку fake_open_meteo через ASGITransport, без сети. Запуск: python -m pytest
+"""
+import asyncio
+import time
+from datetime import datetime, timezone
+
+import httpx
+import pytest
+
+import fake_open_meteo
+from open_meteo import (
+    CircuitBreaker,
+    CircuitOpenError,
+    ForecastBatcher,
+    ForecastCache,
+    HourlyForecast,
+    OpenMeteoClient,
+    TokenBucket,
+    UpstreamError,
+    UpstreamTimeout,
+)
+
+PARAMS = {"latitude": "55.75", "longitude": "37.62", "hourly": "temperature_2m", "timezone": "auto"}
+
+
+def make_client(fake, **options) -> OpenMeteoClient:
+    """Клиент без ограничения частоты, отправляющий запросы прямо в приложение-заглушку"""
+    options.setdefault("rate_limiter", TokenBucket(rate=0))
+    client = OpenMeteoClient(base_url="http://open-meteo.test/v1/forecast", **options)
+    client._client = httpx.AsyncClient(transport=httpx.ASGITransport(app=fake))
+    return client
+
+
+async def set_faults_after(fake, requests: int, **faults) -> None:
+    """Меняет сбои заглушки, как только она получит requests запросов"""
+    while fake.state.requests < requests:
+        await asyncio.sleep(0.001)
+    fake.state.faults.update(faults)
+
+
+def test_retries_503():
+    async def scenario():
+        fake = fake_open_meteo.create_app(error_rate=1, error_status=503)
+        client = make_client(fake, retries=2, deadline=5)
+        recover = asyncio.create_task(set_faults_after(fake, 1, error_rate=0))
+        response = await client.send(PARAMS)
+        await recover
+        assert response.status_code == 200
+        assert fake.state.requests == 2
+        assert client.resilience.retries == 1
+        assert client.breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_retries_429_after_retry_after():
+    async def scenario():
+        fake = fake_open_meteo.create_app(error_rate=1, error_status=429)
+        client = make_client(fake, retries=2, deadline=5)
+        recover = asyncio.create_task(set_faults_after(fake, 1, error_rate=0))
+        started = time.monotonic()
+        response = await client.send(PARAMS)
+        await recover
+        assert response.status_code == 200
+        # Заглушка отвечает на 429 с Retry-After: 1
+        assert time.monotonic() - started >= 1
+        assert client.resilience.retries == 1
+
+    asyncio.run(scenario())
+
+
+def test_deadline_exhausted():
+    async def scenario():
+        fake = fake_open_meteo.create_app(latency=5)
+        # Первая попытка и пауза после неё (не больше 0.4 с) укладываются в бюджет, поэтому попыток минимум две
+        client = make_client(fake, retries=10, deadline=1, attempt_timeout=0.2)
+        started = time.monotonic()
+        with pytest.raises(UpstreamTimeout):
+            await client.send(PARAMS)
+        assert time.monotonic() - started < 1.5
+        assert client.resilience.attempts >= 2
+        assert client.resilience.timeouts == client.resilience.attempts
+
+    asyncio.run(scenario())
+
+
+def test_breaker_opens_recovers_and_reopens():
+    async def scenario():
+        fake = fake_open_meteo.create_app(error_rate=1, error_status=503)
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+        client = make_client(fake, retries=0, breaker=breaker)
+
+        for _ in range(2):
+            with pytest.raises(UpstreamError):
+                await client.send(PARAMS)
+        assert breaker.state == "open"
+        with pytest.raises(CircuitOpenError):
+            await client.send(PARAMS)
+        assert client.resilience.short_circuits == 1
+        assert fake.state.requests == 2
+
+        # half_open -> open: пробная попытка неудачна
+        await asyncio.sleep(0.06)
+        with pytest.raises(UpstreamError):
+            await client.send(PARAMS)
+        assert breaker.state == "open"
+        assert fake.state.requests == 3
+
+        # open -> half_open -> closed: пробная попытка успешна
+        await asyncio.sleep(0.06)
+        assert breaker.allow()
+        assert breaker.state == "half_open"
+        assert not breaker.allow()
+        breaker.release()
+        fake.state.faults["error_rate"] = 0
+        assert (await client.send(PARAMS)).status_code == 200
+        assert breaker.state == "closed"
+        assert breaker.opened == 2
+
+    asyncio.run(scenario())
+
+
+def test_breaker_probe_released_when_deadline_expires_before_sending():
+    async def scenario():
+        fake = fake_open_meteo.create_app(error_rate=1, error_status=503)
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        # Второй запрос ждёт токена дольше бюджета времени
+        client = make_client(fake, retries=1, deadline=0.5, breaker=breaker,
+                             rate_limiter=TokenBucket(rate=1, capacity=1))
+        with pytest.raises(UpstreamTimeout):
+            await client.send(PARAMS)
+        assert fake.state.requests == 1
+        assert breaker.state == "half_open"
+        # Пробная попытка не зависла: автомат снова пропускает запрос
+        assert breaker.allow()
+
+    asyncio.run(scenario())
+
+
+def test_hedge_wins():
+    async def scenario():
+        fake = fake_open_meteo.create_app(slow_rate=1, slow_latency=5)
+        client = make_client(fake, hedge_delay=0.05, attempt_timeout=3, deadline=5)
+        # Первый запрос медленный, дублирующий - быстрый
+        fast = asyncio.create_task(set_faults_after(fake, 1, slow_rate=0))
+        started = time.monotonic()
+        response = await client.send(PARAMS)
+        await fast
+        assert response.status_code == 200
+        assert time.monotonic() - started < 1
+        assert client.resilience.hedges == 1
+        assert client.resilience.hedge_wins == 1
+
+    asyncio.run(scenario())
+
+
+def test_allow_stale_fallback():
+    async def scenario():
+        fake = fake_open_meteo.create_app()
+        client = make_client(fake, retries=0)
+        forecast = await client.fetch_forecast(55.75, 37.62, hourly="temperature_2m", timezone="auto")
+
+        fake.state.faults["error_rate"] = 1
+        with pytest.raises(UpstreamError):
+            await client.fetch_forecast(55.75, 37.62, refresh=True, hourly="temperature_2m", timezone="auto")
+        stale = await client.fetch_forecast(55.75, 37.62, refresh=True, allow_stale=True,
+                                            hourly="temperature_2m", timezone="auto")
+        assert stale is forecast
+        assert client.resilience.stale_fallbacks == 1
+
+    asyncio.run(scenario())
+
+
+def test_pooled_client_is_shared_by_concurrent_requests():
+    async def scenario():
+        fake = fake_open_meteo.create_app(latency=0.01)
+        client = make_client(fake)
+        pooled = client.client
+        # Повторный start() не создаёт новый клиент
+        await client.start()
+        assert client.client is pooled
+
+        responses = await asyncio.gather(*(client.get_forecast(PARAMS) for _ in range(200)))
+        assert all(response.status_code == 200 for response in responses)
+        assert client.client is pooled
+        assert fake.state.requests == 200
+        assert client.stats.requests == 200
+        # ASGITransport не открывает TCP-соединений, поэтому новых соединений нет - все запросы идут через общий пул
+        assert client.stats.new_connections == 0
+        assert client.stats.reused_connections == 200
+
+        await client.close()
+        with pytest.raises(RuntimeError):
+            client.client
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_fetches_of_one_point_share_one_request():
+    async def scenario():
+        fake = fake_open_meteo.create_app(latency=0.05)
+        client = make_client(fake)
+        forecasts = await asyncio.gather(*(
+            client.fetch_forecast(55.75, 37.62, hourly="temperature_2m", timezone="auto") for _ in range(50)
+        ))
+        assert fake.state.requests == 1
+        assert all(forecast is forecasts[0] for forecast in forecasts)
+        assert client.cache.stats.coalesced == 49
+
+        # Следующий запрос берёт прогноз из кэша
+        await client.fetch_forecast(55.75, 37.62, hourly="temperature_2m", timezone="auto")
+        assert fake.state.requests == 1
+
+    asyncio.run(scenario())
+
+
+def test_failed_load_does_not_poison_cache():
+    async def scenario():
+        cache = ForecastCache()
+
+        async def failing():
+            await asyncio.sleep(0.01)
+            raise UpstreamError("Failed to fetch weather data", status_code=503)
+
+        results = await asyncio.gather(*(cache.get_or_load("key", failing) for _ in range(3)),
+                                       return_exceptions=True)
+        assert all(isinstance(result, UpstreamError) for result in results)
+        assert len(cache) == 0
+        assert await cache.get_or_load("key", lambda: asyncio.sleep(0, "loaded")) == "loaded"
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_load_does_not_poison_cache():
+    async def scenario():
+        cache = ForecastCache()
+        started = asyncio.Event()
+
+        async def slow():
+            started.set()
+            await asyncio.sleep(0.05)
+            return "loaded"
+
+        # Отмена одного ожидающего не отменяет загрузку для остальных
+        first = asyncio.create_task(cache.get_or_load("shared", slow))
+        second = asyncio.create_task(cache.get_or_load("shared", slow))
+        await started.wait()
+        first.cancel()
+        assert await second == "loaded"
+        assert first.cancelled()
+        assert cache.get("shared") == "loaded"
+
+        # Отменённая загрузка не оставляет ни записи, ни зависшего ожидания
+        started.clear()
+        waiter = asyncio.create_task(cache.get_or_load("cancelled", slow))
+        await started.wait()
+        cache._inflight["cancelled"].cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert cache.peek("cancelled") is None
+        assert await cache.get_or_load("cancelled", slow) == "loaded"
+
+    asyncio.run(scenario())
+
+
+def test_batch_is_split_into_per_location_results():
+    async def scenario():
+        fake = fake_open_meteo.create_app()
+        client = make_client(fake)
+        batcher = ForecastBatcher(client.send, max_batch_size=10, max_wait=0.05)
+        points = [(50.0 + index, 10.0 + index) for index in range(5)]
+        params = {"hourly": "temperature_2m", "timezone": "auto"}
+        payloads = await asyncio.gather(*(batcher.fetch(latitude, longitude, params) for latitude, longitude in points))
+        assert fake.state.requests == 1
+        assert fake.state.locations == 5
+        assert batcher.stats.batches == 1
+        assert [(payload["latitude"], payload["longitude"]) for payload in payloads] == points
+
+        # Запросы с разными параметрами не попадают в одну пачку
+        await asyncio.gather(batcher.fetch(50.0, 10.0, params),
+                             batcher.fetch(51.0, 11.0, {"hourly": "pressure_msl", "timezone": "auto"}))
+        assert fake.state.requests == 3
+
+    asyncio.run(scenario())
+
+
+def test_failed_batch_raises_in_every_waiter():
+    async def scenario():
+        fake = fake_open_meteo.create_app(error_rate=1, error_status=503)
+        client = make_client(fake, retries=0)
+        results = await asyncio.gather(*(
+            client.fetch_forecast(40.0 + index, 20.0, hourly="temperature_2m", timezone="auto") for index in range(4)
+        ), return_exceptions=True)
+        assert fake.state.requests == 1
+        assert all(isinstance(result, UpstreamError) and result.status_code == 503 for result in results)
+        assert len(client.cache) == 0
+
+        # После сбоя точки снова загружаются одной пачкой
+        fake.state.faults["error_rate"] = 0
+        forecasts = await asyncio.gather(*(
+            client.fetch_forecast(40.0 + index, 20.0, hourly="temperature_2m", timezone="auto") for index in range(4)
+        ))
+        assert fake.state.requests == 2
+        assert len({id(forecast) for forecast in forecasts}) == 4
+
+    asyncio.run(scenario())
+
+
+def test_repeated_local_hour_on_dst_fall_back():
+    # 25 октября 2026 года в Берлине час 02:00 повторяется: сначала CEST (UTC+2), затем CET (UTC+1)
+    payload = {
+        "timezone": "Europe/Berlin",
+        "utc_offset_seconds": 3600,
+        "hourly": {
+            "time": ["2026-10-25T00:00", "2026-10-25T01:00", "2026-10-25T02:00", "2026-10-25T02:00",
+                     "2026-10-25T03:00"],
+            "temperature_2m": [10.0, 9.0, 8.0, 7.0, 6.0],
+        },
+        "current_weather": {"time": "2026-10-25T02:00", "temperature": 7.0, "windspeed": 5.0},
+    }
+    forecast = HourlyForecast.from_payload(payload)
+    first_hour = int(datetime(2026, 10, 24, 22, tzinfo=timezone.utc).timestamp()) // 3600
+    assert list(forecast.hours()) == [first_hour + position for position in range(5)]
+    assert [forecast.value("temperature_2m", first_hour + position) for position in range(5)] == [
+        10.0, 9.0, 8.0, 7.0, 6.0
+    ]
+    assert forecast.local_time(first_hour + 3).utcoffset().total_seconds() == 3600
+    # Текущий час - второй 02:00 по смещению ответа
+    assert forecast.current_hour == first_hour + 3
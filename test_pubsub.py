@@ -0,0 +1,85 @@
+"""Оповещения подписчиков: схлопывание, пропуск неизменных значений, лимит и снятие подписок.
+
+Запуск: python -m pytest
+"""
+import asyncio
+
+import pytest
+
+from pubsub import Broker, BrokerFull
+
+
+def test_unread_values_are_coalesced():
+    async def scenario():
+        broker = Broker()
+        subscription = broker.subscribe(["city:1", "city:2"])
+        assert broker.publish("city:1", 10) == 1
+        assert broker.publish("city:1", 11) == 1
+        broker.publish("city:2", 20)
+        # В ящике по одному значению на тему - последнему
+        assert await subscription.get() == {"city:1": 11, "city:2": 20}
+        assert broker.stats.coalesced == 1
+        assert broker.stats.delivered == 3
+
+        assert await subscription.get(timeout=0.01) == {}
+        broker.publish("city:1", 12)
+        assert await subscription.get() == {"city:1": 12}
+        assert broker.stats.coalesced == 1
+
+    asyncio.run(scenario())
+
+
+def test_unchanged_values_are_suppressed_by_key():
+    async def scenario():
+        broker = Broker()
+        subscription = broker.subscribe(["city:1"])
+        assert broker.publish("city:1", {"temperature": 5, "timestamp": 1}, key=(5,)) == 1
+        # Изменилось только время получения
+        assert broker.publish("city:1", {"temperature": 5, "timestamp": 2}, key=(5,)) == 0
+        assert broker.stats.unchanged == 1
+        assert await subscription.get() == {"city:1": {"temperature": 5, "timestamp": 1}}
+
+        # Значение, которое подписчик получил в снимке, повторно не отправляется
+        broker.remember("city:1", {"temperature": 6, "timestamp": 3}, key=(6,))
+        assert broker.publish("city:1", {"temperature": 6, "timestamp": 4}, key=(6,)) == 0
+        assert broker.publish("city:1", {"temperature": 7, "timestamp": 5}, key=(7,)) == 1
+        assert broker.stats.published == 2
+
+    asyncio.run(scenario())
+
+
+def test_max_subscribers():
+    broker = Broker(max_subscribers=2)
+    first = broker.subscribe(["city:1"])
+    broker.subscribe(["city:1"])
+    with pytest.raises(BrokerFull):
+        broker.subscribe(["city:2"])
+    assert broker.stats.rejected == 1
+    assert broker.stats.subscribers == 2
+
+    broker.unsubscribe(first)
+    broker.subscribe(["city:2"])
+    assert broker.stats.subscribers == 2
+
+
+def test_unsubscribe_cleans_up_topics():
+    broker = Broker()
+    first = broker.subscribe(["city:1", "city:2"])
+    second = broker.subscribe(["city:1"])
+    broker.publish("city:1", 10)
+    broker.publish("city:2", 20)
+
+    broker.unsubscribe(first)
+    assert broker.topics() == ["city:1"]
+    assert broker.count("city:1") == 1
+    # Последнее значение хранится, пока у темы есть подписчики
+    assert broker.publish("city:1", 10) == 0
+
+    broker.unsubscribe(second)
+    assert broker.topics() == []
+    assert broker._last == {}
+    assert broker.stats.subscribers == 0
+    # Повторное снятие подписки не уменьшает счётчик
+    broker.unsubscribe(second)
+    assert broker.stats.subscribers == 0
+    assert broker.publish("city:1", 10) == 0
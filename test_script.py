@@ -0,0 +1,367 @@
+"""Фоновые задачи, подписки, аренды и миграции схемы сервиса на временной базе SQLite.
+
+Open-Meteo заменяет заглушка fake_open_meteo, запросы к сервису идут через ASGITransport. Запуск: python -m pytest
+"""
+import asyncio
+import os
+import tempfile
+from datetime import date, datetime
+
+import httpx
+import pytest
+
+# База создаётся до импорта script: движки создаются при импорте
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'weather.db')}"
+
+import fake_open_meteo
+import script
+from open_meteo import CircuitBreaker
+from test_open_meteo import make_client
+
+
+def run(scenario) -> None:
+    """Выполняет сценарий в новом цикле событий и закрывает соединения с базой, привязанные к нему"""
+    async def wrapped():
+        try:
+            await scenario()
+        finally:
+            await script.engine.dispose()
+            await script.read_engine.dispose()
+
+    asyncio.run(wrapped())
+
+
+def service_client() -> httpx.AsyncClient:
+    """Клиент сервиса без lifespan: фоновые задачи тесты запускают сами"""
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=script.app), base_url="http://service.test")
+
+
+async def forecast_count(city_id: int) -> int:
+    async with script.engine.connect() as conn:
+        return await conn.scalar(
+            script.select(script.func.count()).where(script.WeatherForecastModel.city_id == city_id)
+        )
+
+
+def test_track_city_defers_backfill_until_breaker_resets(monkeypatch):
+    async def scenario():
+        await script.set_up_database()
+        fake = fake_open_meteo.create_app(error_rate=1, error_status=503)
+        client = make_client(fake, retries=0, breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0.3))
+        monkeypatch.setattr(script, "open_meteo", client)
+        backfill = script.ForecastBackfill()
+        monkeypatch.setattr(script, "backfill", backfill)
+
+        async with service_client() as service:
+            user_id = (await service.post("/register_user", json={"username": "deferred"})).json()["user_id"]
+            response = await service.post("/track_city", json={
+                "user_id": user_id, "name": "Berlin", "latitude": 52.52, "longitude": 13.41,
+            })
+        assert response.status_code == 202
+        assert client.breaker.state == "open"
+        # Пока автомат отключения открыт, очередь не получает город и не тратит на него попытку
+        assert backfill.queue.empty()
+        assert backfill.stats.deferred == 1
+
+        fake.state.faults["error_rate"] = 0
+        await asyncio.sleep(0.35)
+        assert backfill.stats.deferred == 0
+        city = backfill.queue.get_nowait()
+        await backfill._backfill([city])
+        assert backfill.stats.errors == 0
+        assert backfill.stats.cities_done == 1
+        assert await forecast_count(city.id) == 1
+
+    run(scenario)
+
+
+async def track_cities(user: str, *cities: tuple) -> list:
+    """Регистрирует пользователя и добавляет ему города (название, широта, долгота), возвращает id городов"""
+    async with service_client() as service:
+        user_id = (await service.post("/register_user", json={"username": user})).json()["user_id"]
+        response = await service.post("/track_cities", json={"user_id": user_id, "cities": [
+            {"name": name, "latitude": latitude, "longitude": longitude} for name, latitude, longitude in cities
+        ]})
+    return response.json()["city_ids"]
+
+
+async def wait_for(condition, timeout: float = 5) -> None:
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(poll(), timeout)
+
+
+def test_backfill_retries_failed_locations_with_backoff(monkeypatch):
+    async def scenario():
+        await script.set_up_database()
+        fake = fake_open_meteo.create_app(error_rate=1, error_status=503)
+        monkeypatch.setattr(script, "open_meteo", make_client(fake, retries=0, breaker=CircuitBreaker(0)))
+        backfill = script.ForecastBackfill(retries=3, backoff=0.05)
+        monkeypatch.setattr(script, "backfill", backfill)
+        worker = asyncio.create_task(backfill.run())
+        try:
+            city_id, = await track_cities("retried", ("Paris", 48.85, 2.35))
+            await wait_for(lambda: backfill.stats.retries == 2)
+            assert backfill.stats.cities_done == 0
+            # Вторая пауза вдвое длиннее первой
+            assert backfill._failures == {city_id: 2}
+
+            fake.state.faults["error_rate"] = 0
+            await wait_for(lambda: backfill.stats.cities_done == 1)
+            assert fake.state.requests == 3
+            assert backfill.stats.given_up == 0
+            assert backfill._failures == {}
+            assert await forecast_count(city_id) == 1
+        finally:
+            worker.cancel()
+
+    run(scenario)
+
+
+def test_backfill_gives_up_after_retries(monkeypatch):
+    async def scenario():
+        await script.set_up_database()
+        fake = fake_open_meteo.create_app(error_rate=1, error_status=503)
+        monkeypatch.setattr(script, "open_meteo", make_client(fake, retries=0, breaker=CircuitBreaker(0)))
+        backfill = script.ForecastBackfill(retries=2, backoff=0.01)
+        monkeypatch.setattr(script, "backfill", backfill)
+        worker = asyncio.create_task(backfill.run())
+        try:
+            city_ids = await track_cities("given_up", ("Rome", 41.9, 12.5), ("Oslo", 59.91, 10.75))
+            await wait_for(lambda: backfill.stats.given_up == 2)
+            await asyncio.sleep(0.05)
+            # Первая попытка и два повтора; обе точки каждый раз уходят одним объединённым запросом
+            assert fake.state.requests == 3
+            assert backfill.stats.retries == 4
+            assert backfill.stats.deferred == 0
+            assert backfill.queue.empty()
+            assert backfill._failures == {}
+            assert [await forecast_count(city_id) for city_id in city_ids] == [0, 0]
+        finally:
+            worker.cancel()
+
+    run(scenario)
+
+
+def test_subscription_released_when_client_leaves_before_first_event():
+    async def scenario():
+        await script.set_up_database()
+        city_id, = await track_cities("subscriber", ("Vienna", 48.21, 16.37))
+        subscribers = script.updates.stats.subscribers
+        response = await script.subscribe_updates(user_id=None, city_id=[city_id])
+        assert script.updates.count(f"city:{city_id}") == 1
+
+        async def receive():
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            # Клиент ушёл: отправить даже заголовки ответа не удаётся
+            raise OSError("Connection reset by peer")
+
+        with pytest.raises(OSError):
+            await response({"type": "http"}, receive, send)
+        assert script.updates.count(f"city:{city_id}") == 0
+        assert script.updates.stats.subscribers == subscribers
+
+    run(scenario)
+
+
+def test_aggregate_hours_skips_gaps():
+    nan = float("nan")
+    values = script.array("f", [1, 2, 3, 4, nan, 6, nan, nan, nan, 10])
+    assert script.aggregate_hours(values, 3) == [
+        {"min": 1.0, "max": 3.0, "mean": 2.0},
+        {"min": 4.0, "max": 6.0, "mean": 5.0},
+        None,
+        {"min": 10.0, "max": 10.0, "mean": 10.0},
+    ]
+
+
+async def lease_holders() -> dict:
+    async with script.engine.connect() as conn:
+        rows = (await conn.execute(script.select(script.LeaseModel.name, script.LeaseModel.holder))).all()
+    return {int(name.rsplit(":", 1)[1]): holder for name, holder in rows}
+
+
+def test_refresh_partitions_split_between_coordinators_and_taken_over():
+    async def scenario():
+        await script.set_up_database()
+        async with script.engine.begin() as conn:
+            await conn.execute(script.LeaseModel.__table__.delete())
+        ttl = 0.2
+        first = script.RefreshCoordinator(partitions=4, ttl=ttl, holder="first")
+        second = script.RefreshCoordinator(partitions=4, ttl=ttl, holder="second")
+
+        # Процесс без разделов берёт один свободный раздел, поэтому разделы сразу расходятся по процессам
+        await first.tick()
+        await second.tick()
+        assert len(first.held) == len(second.held) == 1
+        assert not first.held.keys() & second.held.keys()
+
+        # Разделы, свободные дольше ttl, разбирают и процессы, у которых раздел уже есть
+        await asyncio.sleep(ttl + 0.05)
+        await first.tick()
+        await second.tick()
+        assert not first.held.keys() & second.held.keys()
+        assert first.held.keys() | second.held.keys() == {0, 1, 2, 3}
+        holders = await lease_holders()
+        assert {partition for partition, holder in holders.items() if holder == "first"} == first.held.keys()
+        assert {partition for partition, holder in holders.items() if holder == "second"} == second.held.keys()
+        assert all(first.holds(partition) != second.holds(partition) for partition in range(4))
+
+        # first завис: его аренды истекают, и после ttl без продления их забирает second
+        abandoned = set(first.held)
+        await asyncio.sleep(ttl + 0.05)
+        await second.tick()
+        assert not abandoned & second.held.keys()
+        await asyncio.sleep(ttl + 0.05)
+        await second.tick()
+        assert second.holds_all()
+        assert not any(first.holds(partition) for partition in range(4))
+        assert set((await lease_holders()).values()) == {"second"}
+
+        # Очнувшийся first узнаёт о потере при продлении и не получает чужие действующие аренды
+        await first.tick()
+        assert first.held == {}
+        assert first.stats.lost == len(abandoned)
+
+        # Отпущенные при остановке разделы забираются сразу
+        await second.release()
+        await first.tick()
+        assert first.holds_all()
+        assert first.stats.acquired == len(abandoned) + 4
+
+    run(scenario)
+
+
+# Схема базовой версии сервиса: города без ключей координат, прогнозов у города может быть несколько
+BASELINE_SCHEMA = (
+    "CREATE TABLE users (id INTEGER NOT NULL PRIMARY KEY, username VARCHAR NOT NULL UNIQUE)",
+    ("CREATE TABLE cities (id INTEGER NOT NULL PRIMARY KEY, name VARCHAR NOT NULL, "
+     "latitude FLOAT NOT NULL, longitude FLOAT NOT NULL)"),
+    ("CREATE TABLE user_city_association (user_id INTEGER NOT NULL REFERENCES users (id), "
+     "city_id INTEGER NOT NULL REFERENCES cities (id), PRIMARY KEY (user_id, city_id))"),
+    ("CREATE TABLE weather_forecasts (id INTEGER NOT NULL PRIMARY KEY, city_id INTEGER NOT NULL REFERENCES cities (id), "
+     "timestamp DATETIME NOT NULL, temperature FLOAT, wind_speed FLOAT, atmospheric_pressure FLOAT)"),
+)
+
+
+def use_new_database(monkeypatch):
+    """Переключает сервис на пустую базу в отдельном файле"""
+    url = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'weather.db')}"
+    engine, _ = script.create_engines(url)
+    monkeypatch.setattr(script, "engine", engine)
+    return engine
+
+
+async def select_all(conn, statement: str) -> list:
+    return [tuple(row) for row in (await conn.execute(script.text(statement))).all()]
+
+
+def test_baseline_database_upgrade(monkeypatch):
+    async def scenario():
+        engine = use_new_database(monkeypatch)
+        async with engine.begin() as conn:
+            for statement in BASELINE_SCHEMA:
+                await conn.execute(script.text(statement))
+            await conn.execute(script.text("INSERT INTO users (id, username) VALUES (1, 'anna'), (2, 'boris')"))
+            # Города 1-3 - один и тот же город, координаты совпадают до CITY_COORDINATE_PRECISION знаков
+            await conn.execute(script.text(
+                "INSERT INTO cities (id, name, latitude, longitude) VALUES "
+                "(1, 'Moscow', 55.7558, 37.6173), (2, 'Moscow', 55.75581, 37.61729), "
+                "(3, 'Moscow', 55.7558, 37.6173), (4, 'Kazan', 55.7963, 49.1088)"
+            ))
+            await conn.execute(script.text(
+                "INSERT INTO user_city_association (user_id, city_id) VALUES (1, 1), (1, 2), (2, 3), (2, 4)"
+            ))
+            await conn.execute(script.text(
+                "INSERT INTO weather_forecasts (id, city_id, timestamp, temperature) VALUES "
+                "(1, 1, '2024-01-01 10:00:00', 1.0), (2, 1, '2024-01-01 11:00:00', 2.0), "
+                "(3, 2, '2024-01-01 12:00:00', 3.0), (4, 4, '2024-01-01 12:00:00', 4.0)"
+            ))
+
+        result = await script.set_up_database()
+        assert result == {"message": "schema migrated", "migrations": [
+            "city_location_keys", "forecast_city_unique_index", "association_city_index",
+        ]}
+
+        async with engine.connect() as conn:
+            assert await select_all(conn, "SELECT id, latitude_key, longitude_key FROM cities ORDER BY id") == [
+                (1, script.coordinate_key(55.7558), script.coordinate_key(37.6173)),
+                (4, script.coordinate_key(55.7963), script.coordinate_key(49.1088)),
+            ]
+            # Пользователи дублей перешли к оставшемуся городу без повторных связей
+            assert await select_all(
+                conn, "SELECT user_id, city_id FROM user_city_association ORDER BY user_id, city_id"
+            ) == [(1, 1), (2, 1), (2, 4)]
+            # У города остался последний прогноз
+            assert await select_all(conn, "SELECT id, city_id FROM weather_forecasts ORDER BY id") == [(2, 1), (4, 4)]
+            assert await select_all(conn, "SELECT version FROM schema_migrations ORDER BY version") == [(1,), (2,), (3,)]
+
+            def inspect_schema(connection):
+                inspector = script.inspect(connection)
+                indexes = {
+                    index["name"] for table in ("cities", "weather_forecasts", "user_city_association")
+                    for index in inspector.get_indexes(table)
+                }
+                return indexes, set(inspector.get_table_names())
+
+            indexes, tables = await conn.run_sync(inspect_schema)
+        assert {"uq_cities_location", "ix_cities_grid_cell", "uq_weather_forecasts_city_id",
+                "ix_user_city_association_city_id"} <= indexes
+        assert set(script.Base.metadata.tables) <= tables
+
+        # Повторный запуск ничего не меняет
+        assert await script.set_up_database() == {"message": "schema is up to date"}
+        async with engine.begin() as conn:
+            assert await conn.run_sync(script.migrate_schema) == []
+            assert await select_all(conn, "SELECT count(*) FROM schema_migrations") == [(3,)]
+            assert await select_all(conn, "SELECT count(*) FROM cities") == [(2,)]
+
+    run(scenario)
+
+
+def test_new_database_is_created_at_the_latest_version(monkeypatch):
+    async def scenario():
+        engine = use_new_database(monkeypatch)
+        assert (await script.set_up_database())["message"] == "schema migrated"
+        async with engine.connect() as conn:
+            assert await select_all(conn, "SELECT version FROM schema_migrations ORDER BY version") == [(1,), (2,), (3,)]
+        assert await script.set_up_database() == {"message": "schema is up to date"}
+
+    run(scenario)
+
+
+def test_merging_duplicate_cities_moves_history(monkeypatch):
+    async def scenario():
+        engine = use_new_database(monkeypatch)
+        await script.set_up_database()
+
+        def history(city_id: int, day: date, temperature: float) -> dict:
+            blob = script.pack_hours([temperature] * 24)
+            return {"city_id": city_id, "day": day, "utc_offset_seconds": 0, "updated_at": datetime(2024, 1, 1),
+                    **{name: blob for name in script.HOURLY_VARIABLES}}
+
+        async with engine.begin() as conn:
+            # Дубли, которые могли появиться до уникального индекса
+            await conn.execute(script.text("DROP INDEX uq_cities_location"))
+            await conn.execute(script.text(
+                "INSERT INTO cities (id, name, latitude, longitude, latitude_key, longitude_key, grid_cell) VALUES "
+                "(1, 'Minsk', 53.9, 27.5667, 0, 0, 0), (2, 'Minsk', 53.9, 27.5667, 0, 0, 0)"
+            ))
+            await script.upsert_history(conn, [
+                history(1, date(2024, 1, 1), 1.0), history(2, date(2024, 1, 1), 2.0), history(2, date(2024, 1, 2), 3.0),
+            ])
+            assert await conn.run_sync(script.merge_duplicate_cities) == 1
+
+            rows = (await conn.execute(script.text(
+                "SELECT city_id, day, temperature FROM hourly_forecasts ORDER BY day"
+            ))).all()
+        # Сутки, которые у оставшегося города уже есть, не переписываются
+        assert [(city_id, day, script.unpack_hours(blob)[0]) for city_id, day, blob in rows] == [
+            (1, "2024-01-01", 1.0), (1, "2024-01-02", 3.0),
+        ]
+
+    run(scenario)